@@ -13,21 +13,50 @@ inside Modal Labs.
 
 from __future__ import annotations
 
+import contextlib
+import hashlib
 import os
+import runpy
 import shutil
-import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import modal
 
 
 HERE = Path(__file__).resolve().parent
 REMOTE_REPO_PATH = Path("/workspace/TemStaPro")
-REMOTE_FASTA_DIR = Path("/tmp/temstapro")
+REMOTE_TMP_DIR = Path("/tmp")
+LOCAL_CACHE_ROOT = REMOTE_TMP_DIR / "cache"
 HF_CACHE_ROOT = Path("/cache/hf")
 EMBEDDINGS_CACHE_ROOT = Path("/cache/embeddings")
+TORCH_COMPILE_CACHE_ROOT = Path("/cache/torch-compile")
+INPUTS_ROOT = Path("/cache/inputs")
+# Per-call results are handed back through the runs volume.
+RUNS_ROOT = Path("/cache/runs")
 PROTTRANS_DIR = HF_CACHE_ROOT / "prottrans"
+BAKED_PROTTRANS_DIR = Path("/opt/prottrans")
+PROTTRANS_REPO_ID = "Rostlab/prot_t5_xl_half_uniref50-enc"
+PROTTRANS_REVISION = os.environ.get("PROTTRANS_REVISION", "main")
+FASTA_SUFFIXES = (".fasta", ".fa", ".faa", ".fas")
+HASH_CHUNK_SIZE = 1 << 20
+PLOT_IO_WORKERS = 32
+# Length-bucketed micro-batching of the ProtT5 forward pass: a new batch is
+# started whenever padding would exceed 20% of its tokens. Cached CUDA blocks
+# are released between batches once less than 20% of GPU memory is free.
+EMBEDDING_OPTIONS = {"max_padding": 0.2, "min_free_memory": 0.2}
+# With ``COMPILE=1`` padded lengths are rounded up to this multiple so the
+# compiled encoder only ever sees a small set of sequence lengths. Batch and
+# length dimensions are dynamic; dynamo specialises batch size 1, so warm-up
+# covers it alongside a larger batch.
+COMPILE_LENGTH_MULTIPLE = 128
+COMPILE_WARMUP_LENGTHS = (128, 256, 512, 1024)
+COMPILE_WARMUP_BATCH_SIZES = (1, 2)
 
 
 def _gpu_from_env() -> Optional[modal.gpu.GpuType]:
@@ -47,205 +76,813 @@ def _gpu_from_env() -> Optional[modal.gpu.GpuType]:
 
 GPU_CONFIG = _gpu_from_env()
 TIMEOUT_MINUTES = int(os.environ.get("TIMEOUT", "180"))
+SCALEDOWN_MINUTES = int(os.environ.get("SCALEDOWN", "10"))
+# Requests multiplexed onto one container; only the ProtT5 forward pass is
+# serialised, so FASTA parsing, classifiers and output writing overlap. With
+# ``COMPILE=1``, ``CONCURRENT_INPUTS=1`` lets the encoder use CUDA graphs.
+CONCURRENT_INPUTS = int(os.environ.get("CONCURRENT_INPUTS", "4"))
+COMPILE_MODEL = os.environ.get("COMPILE", "") == "1"
+# Optional placement next to the volumes' storage (e.g. REGION=us-east,
+# CLOUD=aws) so cold ProtTrans loads are not capped by cross-region bandwidth.
+REGION = os.environ.get("REGION") or None
+CLOUD = os.environ.get("CLOUD") or None
+# Bake the ProtTrans snapshot into the image so cold starts skip the volume
+# read; ``BAKE_PROTTRANS=0`` keeps the image small and uses the HF volume.
+BAKE_PROTTRANS = os.environ.get("BAKE_PROTTRANS", "1") == "1"
+
+
+TORCH_VERSION = "2.2.1"
+# Repository files the worker needs: the CLI, its modules and the classifiers.
+REPO_MOUNT_PATTERNS = ("temstapro", "*.py", "models/**")
+
+
+def _prottrans_ref(root: Path, revision: str) -> Path:
+    """Return the file under ``root`` recording the commit ``revision`` resolved to."""
+
+    return root / "refs" / revision
+
+
+def _snapshot_prottrans(root: Path, revision: str) -> str:
+    """Download ProtTrans ``revision`` to ``root/<commit>`` and return the commit.
+
+    Snapshots are keyed by commit hash so several revisions can coexist
+    without duplicating files; ``root/refs/<revision>`` records which commit
+    a branch or tag name resolved to.
+    """
+
+    from huggingface_hub import HfApi, snapshot_download
+
+    commit = HfApi().model_info(PROTTRANS_REPO_ID, revision=revision).sha
+    snapshot_dir = root / commit
+    if not (snapshot_dir / "pytorch_model.bin").is_file():
+        snapshot_download(
+            PROTTRANS_REPO_ID,
+            revision=commit,
+            local_dir=str(snapshot_dir),
+            local_dir_use_symlinks=False,
+        )
+
+    ref_path = _prottrans_ref(root, revision)
+    ref_path.parent.mkdir(parents=True, exist_ok=True)
+    ref_path.write_text(commit)
+    return commit
+
+
+def _bake_prottrans(revision: str) -> None:
+    """Image build step storing the ProtTrans snapshot in its own layer."""
+
+    _snapshot_prottrans(BAKED_PROTTRANS_DIR, revision)
+
+
+def _build_image(torch_variant: str) -> modal.Image:
+    """Return the TemStaPro image with the ``torch_variant`` (cpu, cu121) build.
 
+    Torch (with its own dependencies) is installed from the PyTorch index
+    only, by a separate layer; every other pinned requirement then resolves
+    from PyPI only, so neither index can shadow packages of the other.
+    """
 
-image = (
-    modal.Image.debian_slim(python_version="3.10")
-    .apt_install("git", "ffmpeg", "libgl1")
-    .run_commands(
-        "pip install --no-cache-dir --index-url https://download.pytorch.org/whl/cpu torch==2.2.1"
+    image = (
+        modal.Image.debian_slim(python_version="3.10")
+        .pip_install(
+            f"torch=={TORCH_VERSION}+{torch_variant}",
+            index_url=f"https://download.pytorch.org/whl/{torch_variant}",
+        )
+        .pip_install(
+            "hf-transfer==0.1.6",
+            "huggingface-hub==0.21.4",
+            "matplotlib==3.8.3",
+            "numpy==1.26.4",
+            "pandas==2.2.1",
+            "sentencepiece==0.1.99",
+            "tqdm==4.66.2",
+            "transformers==4.38.2",
+        )
+        .env(
+            {
+                "HF_HUB_ENABLE_HF_TRANSFER": "1",
+                "PYTORCH_CUDA_ALLOC_CONF": "expandable_segments:True,max_split_size_mb:512",
+            }
+        )
     )
-    .pip_install(
-        "huggingface-hub==0.21.4",
-        "matplotlib==3.8.3",
-        "numpy==1.26.4",
-        "pandas==2.2.1",
-        "sentencepiece==0.1.99",
-        "tqdm==4.66.2",
-        "transformers==4.38.2",
+    if BAKE_PROTTRANS:
+        # Cached by revision; the layer is only rebuilt when it changes.
+        image = image.run_function(
+            _bake_prottrans, kwargs={"revision": PROTTRANS_REVISION}
+        )
+    return (
+        image
+        # Mounted at container start rather than built into a layer, so source
+        # edits never invalidate the cached dependency layers above. Only the
+        # files the worker runs are mounted, never local ProtTrans weights or
+        # outputs lying around the checkout.
+        .add_local_dir(
+            HERE,
+            remote_path=str(REMOTE_REPO_PATH),
+            ignore=~modal.FilePatternMatcher(*REPO_MOUNT_PATTERNS),
+        )
     )
-    .run_commands(f"git clone https://github.com/ievapudz/TemStaPro {str(REMOTE_REPO_PATH)}")
-    .run_commands(f"cd {str(REMOTE_REPO_PATH)}")
-)
+
+
+# The CUDA wheel bundles its CUDA/cuDNN runtime, so both images share the
+# slim Debian base; only GPU runs pay for the larger torch build.
+cpu_image = _build_image("cpu")
+gpu_image = _build_image("cu121")
+image = gpu_image if GPU_CONFIG else cpu_image
 
 
 hf_volume = modal.Volume.from_name("temstapro-hf-cache", create_if_missing=True)
 embeddings_volume = modal.Volume.from_name("temstapro-embeddings", create_if_missing=True)
+compile_volume = modal.Volume.from_name("temstapro-torch-compile", create_if_missing=True)
+inputs_volume = modal.Volume.from_name("temstapro-inputs", create_if_missing=True)
+runs_volume = modal.Volume.from_name("temstapro-runs", create_if_missing=True)
 
 
 app = modal.App("temstapro")
 
 
-def _prepare_workdir(fasta_name: str) -> Tuple[Path, Path, Path]:
-    """Create a clean working directory for each remote execution."""
+def _prepare_workdir() -> Tuple[Path, Path, Path]:
+    """Create a fresh, private working directory for each remote execution.
+
+    Concurrent executions never share a directory, and the caller removes it
+    once done, so there is nothing left over to clean up front.
+    """
+
+    workdir = Path(tempfile.mkdtemp(prefix="temstapro_", dir=REMOTE_TMP_DIR))
+    outputs_path = workdir / "outputs"
+    plots_path = workdir / "plots"
+    outputs_path.mkdir()
+    plots_path.mkdir()
+    return workdir, outputs_path, plots_path
+
 
-    if REMOTE_FASTA_DIR.exists():
-        shutil.rmtree(REMOTE_FASTA_DIR)
-    REMOTE_FASTA_DIR.mkdir(parents=True, exist_ok=True)
+def _output_file(outputs_path: Path, key: str, name: Optional[str]) -> Optional[Path]:
+    """Return a path for output ``key`` in its own subdirectory of ``outputs_path``.
 
-    input_path = REMOTE_FASTA_DIR / fasta_name
-    outputs_path = REMOTE_FASTA_DIR / "outputs"
-    plots_path = REMOTE_FASTA_DIR / "plots"
-    outputs_path.mkdir(parents=True, exist_ok=True)
-    plots_path.mkdir(parents=True, exist_ok=True)
-    return input_path, outputs_path, plots_path
+    Output names may coincide (batch runs name every output of a FASTA file
+    after its stem), so each output identifier gets a separate directory.
+    """
 
+    if not name:
+        return None
+    output_dir = outputs_path / key
+    output_dir.mkdir()
+    return output_dir / name
 
-def _env_prepare() -> None:
-    """Ensure cache directories exist and update env vars for huggingface/torch."""
 
-    for path in (HF_CACHE_ROOT, EMBEDDINGS_CACHE_ROOT, PROTTRANS_DIR):
+def _env_prepare(hf_cache_writable: bool = False) -> None:
+    """Ensure cache directories exist and update env vars for huggingface/torch.
+
+    The HF cache is mounted read-only for inference, so its directories are
+    only created when ``hf_cache_writable`` is set. Caches written at runtime
+    (matplotlib fonts, transformers bookkeeping) live on local disk instead.
+    """
+
+    paths = [EMBEDDINGS_CACHE_ROOT, TORCH_COMPILE_CACHE_ROOT, LOCAL_CACHE_ROOT]
+    if hf_cache_writable:
+        paths.extend((HF_CACHE_ROOT, PROTTRANS_DIR))
+    for path in paths:
         path.mkdir(parents=True, exist_ok=True)
 
     os.environ.setdefault("HF_HOME", str(HF_CACHE_ROOT))
-    os.environ.setdefault("TRANSFORMERS_CACHE", str(HF_CACHE_ROOT / "transformers"))
-    os.environ.setdefault("XDG_CACHE_HOME", str(HF_CACHE_ROOT))
-    os.environ.setdefault("TORCH_HOME", str(HF_CACHE_ROOT / "torch"))
+    os.environ.setdefault("TRANSFORMERS_CACHE", str(LOCAL_CACHE_ROOT / "transformers"))
+    os.environ.setdefault("XDG_CACHE_HOME", str(LOCAL_CACHE_ROOT))
+    os.environ.setdefault("TORCH_HOME", str(LOCAL_CACHE_ROOT / "torch"))
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(TORCH_COMPILE_CACHE_ROOT))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+
+def _embedding_dtype() -> Optional["torch.dtype"]:
+    """Pick the ProtT5 precision for the available hardware.
+
+    The checkpoint is stored in half precision; FP16 runs on tensor cores of
+    A10G/L4/A100, BF16 is preferred from Hopper (H100) on. CPU containers keep
+    the default FP32.
+    """
+
+    import torch
+
+    if not torch.cuda.is_available():
+        return None
+    if torch.cuda.get_device_capability()[0] >= 9:
+        return torch.bfloat16
+    return torch.float16
+
+
+class _SerializedForward:
+    """Callable wrapper allowing one ``model`` forward pass at a time."""
 
+    def __init__(self, model: Callable[..., object], lock: threading.Lock) -> None:
+        self.model = model
+        self.lock = lock
 
-def _collect_outputs(paths: Dict[str, Optional[Path]]) -> Dict[str, Optional[bytes]]:
-    """Return the contents of generated files keyed by output identifier."""
+    def __call__(self, *args: object, **kwargs: object) -> object:
+        with self.lock:
+            return self.model(*args, **kwargs)
 
-    results: Dict[str, Optional[bytes]] = {}
+
+def _reload_volumes() -> None:
+    """Pick up inputs and cached embeddings committed by other containers.
+
+    TemStaPro (``-e``) stores embeddings as ``{mean,per_res}_<sha256>.pt`` and
+    only encodes sequences whose hash is missing from the cache, so seeing
+    the latest volume state lets repeated sequences skip ProtT5 entirely.
+    """
+
+    inputs_volume.reload()
+    embeddings_volume.reload()
+
+
+def _volume_path(path: Path) -> str:
+    """Return ``path`` relative to the root of the runs volume."""
+
+    return str(path.relative_to(RUNS_ROOT))
+
+
+def _store_outputs(
+    run_dir: Path, paths: Dict[str, Optional[Path]]
+) -> Dict[str, Optional[str]]:
+    """Copy generated files into ``run_dir`` and return their volume paths.
+
+    Each output identifier keeps its own subdirectory (see ``_output_file``).
+    """
+
+    results: Dict[str, Optional[str]] = {}
     for key, output_path in paths.items():
         if output_path and output_path.exists():
-            results[key] = output_path.read_bytes()
+            target = run_dir / key / output_path.name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(output_path, target)
+            results[key] = _volume_path(target)
         else:
             results[key] = None
     return results
 
 
-def _gather_plot_files(plot_dir: Path) -> List[Tuple[str, bytes]]:
-    """Return relative paths and bytes for every file found in ``plot_dir``."""
+def _store_plots(run_dir: Path, plot_dir: Path) -> List[Tuple[str, str]]:
+    """Copy ``plot_dir`` into ``run_dir``; return (relative, volume path) pairs."""
 
     if not plot_dir.exists():
         return []
 
-    entries: List[Tuple[str, bytes]] = []
-    for file_path in sorted(plot_dir.rglob("*")):
-        if file_path.is_file():
-            rel = file_path.relative_to(plot_dir)
-            entries.append((str(rel), file_path.read_bytes()))
-    return entries
+    target_dir = run_dir / "plots"
+    shutil.copytree(plot_dir, target_dir)
+    return [
+        (str(path.relative_to(target_dir)), _volume_path(path))
+        for path in sorted(target_dir.rglob("*"))
+        if path.is_file()
+    ]
 
 
 @app.function(
+    image=image,
+    timeout=TIMEOUT_MINUTES * 60,
+    region=REGION,
+    cloud=CLOUD,
+    volumes={str(HF_CACHE_ROOT): hf_volume},
+    # Cold containers may all request the snapshot at once; one download at a
+    # time means later calls find it committed and only refresh the ref.
+    max_containers=1,
+)
+def download_prottrans(revision: str = PROTTRANS_REVISION) -> str:
+    """Populate the HF volume with a ProtTrans snapshot keyed by commit hash.
+
+    Only needed for revisions not baked into the image (see ``BAKE_PROTTRANS``).
+    """
+
+    _env_prepare(hf_cache_writable=True)
+    # Pick up snapshots committed by earlier calls.
+    hf_volume.reload()
+
+    commit = _snapshot_prottrans(PROTTRANS_DIR, revision)
+    hf_volume.commit()
+    return commit
+
+
+@app.cls(
     image=image,
     gpu=GPU_CONFIG,
     timeout=TIMEOUT_MINUTES * 60,
+    scaledown_window=SCALEDOWN_MINUTES * 60,
+    region=REGION,
+    cloud=CLOUD,
     volumes={
-        str(HF_CACHE_ROOT): hf_volume,
+        str(HF_CACHE_ROOT): hf_volume.read_only(),
         str(EMBEDDINGS_CACHE_ROOT): embeddings_volume,
+        str(TORCH_COMPILE_CACHE_ROOT): compile_volume,
+        str(INPUTS_ROOT): inputs_volume.read_only(),
+        str(RUNS_ROOT): runs_volume,
     },
 )
-def run_temstapro(
-    *,
-    fasta_bytes: bytes,
-    fasta_name: str,
-    more_thresholds: bool,
-    portion_size: int,
-    segment_size: int,
-    window_size_predictions: int,
-    curve_smoothening: bool,
-    include_plots: bool,
-    mean_output_name: Optional[str],
-    per_res_output_name: Optional[str],
-    per_segment_output_name: Optional[str],
-) -> Dict[str, object]:
-    """Remote execution wrapper around the original TemStaPro CLI."""
-
-    _env_prepare()
-    input_path, outputs_path, plots_path = _prepare_workdir(fasta_name)
-    input_path.write_bytes(fasta_bytes)
-
-    mean_output_path = outputs_path / mean_output_name if mean_output_name else None
-    per_res_output_path = (
-        outputs_path / per_res_output_name if per_res_output_name else None
-    )
-    per_segment_output_path = (
-        outputs_path / per_segment_output_name if per_segment_output_name else None
-    )
+@modal.concurrent(max_inputs=CONCURRENT_INPUTS)
+class TemStaPro:
+    """Warm TemStaPro worker keeping ProtTrans and the classifiers resident."""
 
-    cmd: List[str] = [
-        "python",
-        str(REMOTE_REPO_PATH / "temstapro"),
-        "-f",
-        str(input_path),
-        "-d",
-        str(PROTTRANS_DIR),
-        "-t",
-        str(REMOTE_REPO_PATH),
-        "-e",
-        str(EMBEDDINGS_CACHE_ROOT),
-        "--portion-size",
-        str(portion_size),
-        "--segment-size",
-        str(segment_size),
-        "--window-size-predictions",
-        str(window_size_predictions),
-    ]
+    revision: str = modal.parameter(default=PROTTRANS_REVISION)
+    compile_model: bool = modal.parameter(default=False)
 
-    if more_thresholds:
-        cmd.append("--more-thresholds")
-    if curve_smoothening:
-        cmd.append("--curve-smoothening")
-    if mean_output_path:
-        cmd.extend(["--mean-output", str(mean_output_path)])
-    if per_res_output_path:
-        cmd.extend(["--per-res-output", str(per_res_output_path)])
-    if per_segment_output_path:
-        cmd.extend(["--per-segment-output", str(per_segment_output_path)])
-    if include_plots:
-        cmd.extend(["--per-residue-plot-dir", str(plots_path)])
-
-    completed = subprocess.run(
-        cmd,
-        check=False,
-        capture_output=True,
-        text=True,
-    )
+    @modal.enter()
+    def load(self) -> None:
+        """Import the TemStaPro CLI and load its models once per container."""
 
-    if completed.returncode != 0:
-        raise RuntimeError(
-            "TemStaPro execution failed with return code "
-            f"{completed.returncode}\nSTDOUT:\n{completed.stdout}\nSTDERR:\n{completed.stderr}"
-        )
+        _env_prepare()
 
-    file_payload = _collect_outputs(
-        {
-            "mean": mean_output_path,
-            "per_res": per_res_output_path,
-            "per_segment": per_segment_output_path,
-        }
-    )
+        baked_ref = _prottrans_ref(BAKED_PROTTRANS_DIR, self.revision)
+        if baked_ref.is_file():
+            self.pt_dir = BAKED_PROTTRANS_DIR / baked_ref.read_text().strip()
+        else:
+            ref_path = _prottrans_ref(PROTTRANS_DIR, self.revision)
+            if not ref_path.is_file():
+                download_prottrans.remote(self.revision)
+                hf_volume.reload()
+            self.pt_dir = PROTTRANS_DIR / ref_path.read_text().strip()
+
+        if str(REMOTE_REPO_PATH) not in sys.path:
+            sys.path.append(str(REMOTE_REPO_PATH))
 
-    plots_payload = _gather_plot_files(plots_path) if include_plots else []
+        import model_flow
+        import prottrans_models
+        import torch
 
-    return {
-        "stdout": completed.stdout,
-        "stderr": completed.stderr,
-        "files": file_payload,
-        "plots": plots_payload,
-    }
+        # TF32 tensor cores for any matmul left in FP32.
+        torch.backends.cuda.matmul.allow_tf32 = True
 
+        cli_globals = runpy.run_path(
+            str(REMOTE_REPO_PATH / "temstapro"), run_name="temstapro"
+        )
+        parameters = dict(cli_globals["PARAMETERS"])
+        parameters["CLASSIFIERS_DIR"] = str(REMOTE_REPO_PATH / "models")
 
-def _write_optional_file(output_path: Optional[str], payload: Optional[bytes]) -> None:
-    if output_path and payload is not None:
-        destination = Path(output_path)
-        destination.parent.mkdir(parents=True, exist_ok=True)
-        destination.write_bytes(payload)
+        self.cli_main = cli_globals["main"]
+        self.pt_model, self.tokenizer = prottrans_models.load_model_and_tokenizer(
+            str(self.pt_dir), parameters["PT_MODEL_PATH"], _embedding_dtype()
+        )
+        # Loading the widest thresholds range covers ``--more-thresholds`` too.
+        self.classifiers = model_flow.load_classifiers(
+            parameters, parameters["THRESHOLDS"][":(40-80]:"]
+        )
+
+        self.embedding_options = dict(EMBEDDING_OPTIONS)
+        self.compiled_graphs = 0
+        if self.compile_model and torch.cuda.is_available():
+            self._compile_pt_model()
+
+        # Concurrent inputs run in threads: the encoder forward pass is
+        # serialised to bound GPU memory, and matplotlib's global state only
+        # allows one plotting run at a time.
+        self.pt_model = _SerializedForward(self.pt_model, threading.Lock())
+        self.plot_lock = threading.Lock()
+        self.volumes_idle = threading.Condition()
+        self.in_flight = 0
+        self.reload_pending = False
+
+    def _compile_pt_model(self) -> None:
+        """Compile the ProtT5 encoder and warm it up for common lengths.
+
+        ``max-autotune`` also captures CUDA graphs, cutting per-layer launch
+        overhead, but only for a single input per container: graph outputs
+        are overwritten by the next replay once the forward lock is released,
+        and captured graphs are not shared between Modal's worker threads.
+        Inductor artefacts are stored on the compile cache volume, so later
+        containers reuse them instead of autotuning again.
+        """
+
+        import prottrans_models
+        import torch
+
+        # Dynamic shapes keep the batch sizes ``get_embeddings`` produces
+        # (1 to ``max_batch``) from each triggering a fresh autotuning run.
+        mode = "max-autotune"
+        if CONCURRENT_INPUTS > 1:
+            mode = "max-autotune-no-cudagraphs"
+        self.pt_model = torch.compile(
+            self.pt_model, mode=mode, fullgraph=False, dynamic=True
+        )
+        self.embedding_options["pad_to_multiple_of"] = COMPILE_LENGTH_MULTIPLE
+
+        for length in COMPILE_WARMUP_LENGTHS:
+            for batch_size in COMPILE_WARMUP_BATCH_SIZES:
+                # One token is taken by the end-of-sequence marker.
+                prottrans_models.get_embeddings(
+                    self.pt_model,
+                    self.tokenizer,
+                    {f"warmup_{i}": "A" * (length - 1) for i in range(batch_size)},
+                    per_residue=False,
+                    per_protein=True,
+                    **self.embedding_options,
+                )
+        self._commit_compile_cache()
+
+    def _commit_compile_cache(self) -> None:
+        """Persist Inductor artefacts of any graph compiled since the last commit."""
+
+        from torch._dynamo.utils import counters
+
+        compiled_graphs = counters["stats"]["unique_graphs"]
+        if compiled_graphs != self.compiled_graphs:
+            self.compiled_graphs = compiled_graphs
+            compile_volume.commit()
+
+    def _predict(
+        self,
+        *,
+        fasta_key: str,
+        more_thresholds: bool,
+        portion_size: int,
+        segment_size: int,
+        window_size_predictions: int,
+        curve_smoothening: bool,
+        compute_plots: bool,
+        mean_output_name: Optional[str],
+        per_res_output_name: Optional[str],
+        per_segment_output_name: Optional[str],
+    ) -> Dict[str, object]:
+        """Run TemStaPro on one uploaded FASTA file using the preloaded models.
+
+        Outputs are stored on the runs volume under ``<run_id>``
+        (committed when the volume session ends); only their volume paths are
+        returned.
+        """
+
+        input_path = INPUTS_ROOT / fasta_key
+        workdir, outputs_path, plots_path = _prepare_workdir()
+
+        try:
+            mean_output_path = _output_file(outputs_path, "mean", mean_output_name)
+            per_res_output_path = _output_file(
+                outputs_path, "per_res", per_res_output_name
+            )
+            per_segment_output_path = _output_file(
+                outputs_path, "per_segment", per_segment_output_name
+            )
+
+            argv: List[str] = [
+                "-f",
+                str(input_path),
+                "-d",
+                str(self.pt_dir),
+                "-t",
+                str(REMOTE_REPO_PATH),
+                "-e",
+                str(EMBEDDINGS_CACHE_ROOT),
+                "--portion-size",
+                str(portion_size),
+                "--segment-size",
+                str(segment_size),
+            ]
+
+            if more_thresholds:
+                argv.append("--more-thresholds")
+            if mean_output_path:
+                argv.extend(["--mean-output", str(mean_output_path)])
+            if per_res_output_path:
+                argv.extend(["--per-res-output", str(per_res_output_path)])
+            if per_segment_output_path:
+                argv.extend(["--per-segment-output", str(per_segment_output_path)])
+            # Plot-only options are dropped unless plots are requested, so that
+            # TemStaPro never touches its plotting code (nor imports matplotlib).
+            if compute_plots:
+                argv.extend(["--per-residue-plot-dir", str(plots_path)])
+                argv.extend(["--window-size-predictions", str(window_size_predictions)])
+                if curve_smoothening:
+                    argv.append("--curve-smoothening")
+
+            # TemStaPro's stdout/stderr go straight to the container logs, which Modal
+            # streams back to the local terminal.
+            with self.plot_lock if compute_plots else contextlib.nullcontext():
+                returncode = self.cli_main(
+                    argv,
+                    pt_model=self.pt_model,
+                    tokenizer=self.tokenizer,
+                    classifiers=self.classifiers,
+                    embedding_options=self.embedding_options,
+                )
+
+            if returncode != 0:
+                raise RuntimeError(
+                    f"TemStaPro execution failed with return code {returncode}; "
+                    "see the logs above for details."
+                )
+
+            run_id = uuid.uuid4().hex
+            run_dir = RUNS_ROOT / run_id
+            try:
+                file_manifest = _store_outputs(
+                    run_dir,
+                    {
+                        "mean": mean_output_path,
+                        "per_res": per_res_output_path,
+                        "per_segment": per_segment_output_path,
+                    },
+                )
+
+                results: Dict[str, object] = {
+                    "run_id": run_id,
+                    "files": file_manifest,
+                }
+                if compute_plots:
+                    results["plots"] = _store_plots(run_dir, plots_path)
+            except BaseException:
+                shutil.rmtree(run_dir, ignore_errors=True)
+                raise
+            return results
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def _volume_session(self, fasta_keys: List[str]) -> Iterator[None]:
+        """Refresh the volumes for a call and commit new embeddings after it.
+
+        A volume can only be reloaded while none of its files are open, i.e.
+        when no other input of this container is in flight. Calls whose
+        inputs are not visible yet wait for that moment, and hold back new
+        calls meanwhile so the reload cannot be starved; others skip the
+        reload and work with the current view.
+        """
+
+        with self.volumes_idle:
+            self.volumes_idle.wait_for(lambda: not self.reload_pending)
+            if not all((INPUTS_ROOT / key).is_file() for key in fasta_keys):
+                self.reload_pending = True
+                self.volumes_idle.wait_for(lambda: self.in_flight == 0)
+                try:
+                    _reload_volumes()
+                finally:
+                    self.reload_pending = False
+                    self.volumes_idle.notify_all()
+            elif self.in_flight == 0:
+                _reload_volumes()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            # Committed while still in flight, so no reload can start before
+            # this call's embeddings and outputs are persisted.
+            try:
+                embeddings_volume.commit()
+                runs_volume.commit()
+                # Shapes missed by the warm-up may have compiled in this call.
+                self._commit_compile_cache()
+            finally:
+                with self.volumes_idle:
+                    self.in_flight -= 1
+                    self.volumes_idle.notify_all()
+
+    @modal.method()
+    def run(
+        self,
+        *,
+        fasta_key: str,
+        more_thresholds: bool,
+        portion_size: int,
+        segment_size: int,
+        window_size_predictions: int,
+        curve_smoothening: bool,
+        compute_plots: bool,
+        mean_output_name: Optional[str],
+        per_res_output_name: Optional[str],
+        per_segment_output_name: Optional[str],
+    ) -> Dict[str, object]:
+        """Remote execution wrapper around the original TemStaPro CLI.
+
+        ``fasta_key`` is the FASTA file's path within the inputs volume, as
+        returned by ``_upload_fastas``.
+        """
+
+        with self._volume_session([fasta_key]):
+            return self._predict(
+                fasta_key=fasta_key,
+                more_thresholds=more_thresholds,
+                portion_size=portion_size,
+                segment_size=segment_size,
+                window_size_predictions=window_size_predictions,
+                curve_smoothening=curve_smoothening,
+                compute_plots=compute_plots,
+                mean_output_name=mean_output_name,
+                per_res_output_name=per_res_output_name,
+                per_segment_output_name=per_segment_output_name,
+            )
+
+    @modal.method()
+    def run_batch(
+        self,
+        fasta_keys: List[str],
+        *,
+        more_thresholds: bool,
+        portion_size: int,
+        segment_size: int,
+        window_size_predictions: int,
+        curve_smoothening: bool,
+        compute_plots: bool,
+        mean_output: bool,
+        per_res_output: bool,
+        per_segment_output: bool,
+    ) -> List[Dict[str, object]]:
+        """Run TemStaPro on several FASTA files within a single remote call.
+
+        Output files are named after each FASTA file's stem; results are
+        returned in the order of ``fasta_keys``. If any file fails, the runs
+        already stored for the others are removed, as their ids never reach
+        the caller.
+        """
+
+        batch_results: List[Dict[str, object]] = []
+        with self._volume_session(fasta_keys):
+            try:
+                for fasta_key in fasta_keys:
+                    output_name = f"{Path(fasta_key).stem}.tsv"
+                    batch_results.append(
+                        self._predict(
+                            fasta_key=fasta_key,
+                            more_thresholds=more_thresholds,
+                            portion_size=portion_size,
+                            segment_size=segment_size,
+                            window_size_predictions=window_size_predictions,
+                            curve_smoothening=curve_smoothening,
+                            compute_plots=compute_plots,
+                            mean_output_name=output_name if mean_output else None,
+                            per_res_output_name=(
+                                output_name if per_res_output else None
+                            ),
+                            per_segment_output_name=(
+                                output_name if per_segment_output else None
+                            ),
+                        )
+                    )
+            except BaseException:
+                for results in batch_results:
+                    run_dir = RUNS_ROOT / str(results["run_id"])
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                raise
+        return batch_results
+
+
+def _runner() -> TemStaPro:
+    """Return the remote worker configured from the local environment."""
+
+    return TemStaPro(revision=PROTTRANS_REVISION, compile_model=COMPILE_MODEL)
+
+
+def _download_file(volume_path: str, destination: Path) -> None:
+    """Stream ``volume_path`` from the runs volume into ``destination``."""
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with destination.open("wb") as handle:
+        for chunk in runs_volume.read_file(volume_path):
+            handle.write(chunk)
+
+
+def _write_optional_file(
+    output_path: Optional[str], volume_path: Optional[str]
+) -> None:
+    if output_path and volume_path is not None:
+        _download_file(volume_path, Path(output_path))
 
 
-def _write_plots(plot_dir: Optional[str], plots: Iterable[Tuple[str, bytes]]) -> None:
+def _write_plots(plot_dir: Optional[str], plots: Iterable[Tuple[str, str]]) -> None:
     if not plot_dir:
         return
 
     base = Path(plot_dir)
     base.mkdir(parents=True, exist_ok=True)
-    for relative_path, blob in plots:
-        target = base / relative_path
-        target.parent.mkdir(parents=True, exist_ok=True)
-        target.write_bytes(blob)
+
+    def write_plot(entry: Tuple[str, str]) -> None:
+        relative_path, volume_path = entry
+        _download_file(volume_path, base / relative_path)
+
+    with ThreadPoolExecutor(max_workers=PLOT_IO_WORKERS) as executor:
+        # Consuming the iterator re-raises any write error.
+        list(executor.map(write_plot, plots))
+
+
+def _remove_run(results: Dict[str, object]) -> None:
+    """Delete a run's outputs from the runs volume."""
+
+    runs_volume.remove_file(str(results["run_id"]), recursive=True)
+
+
+def _download_run(
+    results: Dict[str, object],
+    *,
+    output_path: Optional[str],
+    per_res_output: Optional[str],
+    per_segment_output: Optional[str],
+    plot_dir: Optional[str],
+) -> None:
+    """Save the outputs and plots of one run to the requested local paths."""
+
+    files_dict = dict(results.get("files") or {})
+    _write_optional_file(output_path, files_dict.get("mean"))
+    _write_optional_file(per_res_output, files_dict.get("per_res"))
+    _write_optional_file(per_segment_output, files_dict.get("per_segment"))
+    if plot_dir:
+        _write_plots(plot_dir, list(results.get("plots") or []))
+
+
+def _sha256_file(path: Path) -> str:
+    """Hash a file in fixed-size chunks without loading it into memory."""
+
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _upload_fastas(fasta_files: List[Path]) -> List[str]:
+    """Upload FASTA files to the inputs volume and return their keys.
+
+    Files are keyed by the SHA-256 of their contents, so repeated inputs map
+    to the same location and only their path crosses the RPC boundary.
+    """
+
+    keys: List[str] = []
+    with inputs_volume.batch_upload(force=True) as batch:
+        for fasta_file in fasta_files:
+            key = f"{_sha256_file(fasta_file)}/{fasta_file.name}"
+            batch.put_file(fasta_file, f"/{key}")
+            keys.append(key)
+    return keys
+
+
+def _fasta_files(fasta_dir: Path) -> List[Path]:
+    """Return the FASTA files found directly inside ``fasta_dir``."""
+
+    return sorted(
+        path
+        for path in fasta_dir.iterdir()
+        if path.is_file() and path.suffix.lower() in FASTA_SUFFIXES
+    )
+
+
+def _output_in_dir(output_dir: Optional[str], fasta_file: Path) -> Optional[str]:
+    """Return the per-FASTA output path inside ``output_dir`` if requested."""
+
+    if not output_dir:
+        return None
+    return str(Path(output_dir) / f"{fasta_file.stem}.tsv")
+
+
+def _run_directory(
+    fasta_dir: Path,
+    *,
+    fan_out: bool,
+    output_path: Optional[str],
+    per_res_output: Optional[str],
+    per_segment_output: Optional[str],
+    plot_dir: Optional[str],
+    options: Dict[str, object],
+) -> None:
+    """Predict every FASTA file in ``fasta_dir`` and save results per file."""
+
+    fasta_files = _fasta_files(fasta_dir)
+    if not fasta_files:
+        raise FileNotFoundError(f"No FASTA files found in: {fasta_dir}")
+
+    fasta_keys = _upload_fastas(fasta_files)
+    batch_kwargs = dict(
+        options,
+        compute_plots=bool(plot_dir),
+        mean_output=bool(output_path),
+        per_res_output=bool(per_res_output),
+        per_segment_output=bool(per_segment_output),
+    )
+
+    runner = _runner()
+    batch_results: List[Dict[str, object]] = []
+    try:
+        if fan_out:
+            # One input per FASTA file, spread over as many containers as
+            # Modal scales up to. Every input is awaited, so the runs of
+            # successful inputs are removed below even when another fails.
+            failures: List[BaseException] = []
+            for results in runner.run_batch.map(
+                [[fasta_key] for fasta_key in fasta_keys],
+                kwargs=batch_kwargs,
+                order_outputs=True,
+                return_exceptions=True,
+            ):
+                if isinstance(results, BaseException):
+                    failures.append(results)
+                else:
+                    batch_results.extend(results)
+            if failures:
+                raise failures[0]
+        else:
+            batch_results.extend(runner.run_batch.remote(fasta_keys, **batch_kwargs))
+
+        for fasta_file, results in zip(fasta_files, batch_results):
+            _download_run(
+                results,
+                output_path=_output_in_dir(output_path, fasta_file),
+                per_res_output=_output_in_dir(per_res_output, fasta_file),
+                per_segment_output=_output_in_dir(per_segment_output, fasta_file),
+                plot_dir=str(Path(plot_dir) / fasta_file.stem) if plot_dir else None,
+            )
+    finally:
+        # Runs are removed even if a download failed, so none are left behind.
+        for results in batch_results:
+            _remove_run(results)
 
 
 @app.local_entrypoint()
@@ -261,22 +898,45 @@ def main(
     segment_size: int = 41,
     window_size_predictions: int = 81,
     curve_smoothening: bool = False,
+    fan_out: bool = False,
 ) -> None:
-    """Run TemStaPro remotely on Modal using local CLI-style arguments."""
+    """Run TemStaPro remotely on Modal using local CLI-style arguments.
+
+    ``fasta_path`` may also be a directory, in which case every FASTA file in
+    it is predicted and the output arguments are treated as directories.
+    """
 
     fasta_file = Path(fasta_path)
+    if fasta_file.is_dir():
+        _run_directory(
+            fasta_file,
+            fan_out=fan_out,
+            output_path=output_path,
+            per_res_output=per_res_output,
+            per_segment_output=per_segment_output,
+            plot_dir=plot_dir,
+            options={
+                "more_thresholds": more_thresholds,
+                "portion_size": portion_size,
+                "segment_size": segment_size,
+                "window_size_predictions": window_size_predictions,
+                "curve_smoothening": curve_smoothening,
+            },
+        )
+        return
+
     if not fasta_file.is_file():
         raise FileNotFoundError(f"FASTA file not found: {fasta_path}")
 
-    results = run_temstapro.remote(
-        fasta_bytes=fasta_file.read_bytes(),
-        fasta_name=fasta_file.name,
+    (fasta_key,) = _upload_fastas([fasta_file])
+    results = _runner().run.remote(
+        fasta_key=fasta_key,
         more_thresholds=more_thresholds,
         portion_size=portion_size,
         segment_size=segment_size,
         window_size_predictions=window_size_predictions,
         curve_smoothening=curve_smoothening,
-        include_plots=bool(plot_dir),
+        compute_plots=bool(plot_dir),
         mean_output_name=Path(output_path).name if output_path else None,
         per_res_output_name=Path(per_res_output).name if per_res_output else None,
         per_segment_output_name=(
@@ -284,17 +944,13 @@ def main(
         ),
     )
 
-    files_dict = dict(results.get("files") or {})
-    plots_list = list(results.get("plots") or [])
-
-    _write_optional_file(output_path, files_dict.get("mean"))
-    _write_optional_file(per_res_output, files_dict.get("per_res"))
-    _write_optional_file(per_segment_output, files_dict.get("per_segment"))
-    _write_plots(plot_dir, plots_list)
-
-    stdout = results.get("stdout")
-    stderr = results.get("stderr")
-    if stdout:
-        print(stdout, end="")
-    if stderr:
-        print(stderr, end="", file=os.sys.stderr)
+    try:
+        _download_run(
+            results,
+            output_path=output_path,
+            per_res_output=per_res_output,
+            per_segment_output=per_segment_output,
+            plot_dir=plot_dir,
+        )
+    finally:
+        _remove_run(results)
@@ -82,21 +82,70 @@ def inference_epoch(model, test_loader, identifiers=[], device="cpu"):
 	returns DICT with inferences 
 	"""
 	inferences = {}
-	for i, data in enumerate(test_loader, 0):
-		inputs, targets = data
-		inputs, targets = inputs.to(device), targets.to(device)
-		outputs = model(inputs.float())
-		outputs = outputs.detach().cpu().numpy()
-		
-		seq_id = identifiers[i]
-		
-		for output in outputs: 
-			inferences[seq_id] = output[0]
+	with torch.inference_mode():
+		for i, data in enumerate(test_loader, 0):
+			inputs, targets = data
+			inputs, targets = inputs.to(device), targets.to(device)
+			outputs = model(inputs.float())
+			outputs = outputs.detach().cpu().numpy()
+			
+			seq_id = identifiers[i]
+			
+			for output in outputs: 
+				inferences[seq_id] = output[0]
 
 	return inferences
 
+def load_classifier(parameters, threshold, seed):
+	"""
+	Loading a single classifier of the ensemble.
+
+	parameters - DICT with values of keys: INPUT_SIZE, HIDDEN_LAYER_SIZES, CLASSIFIERS_DIR, EMB_TYPE, DATASET, CLASSIFIER_TYPE, DEVICE
+	threshold - STRING of the temperature threshold of the classifier
+	seed - STRING of the seed, with which the classifier was trained
+
+	returns MLP_C2H2
+	"""
+	classifier = MLP_C2H2(parameters["INPUT_SIZE"], 
+		parameters["HIDDEN_LAYER_SIZES"][0],
+		parameters["HIDDEN_LAYER_SIZES"][1])
+	model_path = "%s/%s_%s_%s-%s_s%s.pt" % (
+		parameters["CLASSIFIERS_DIR"], parameters["EMB_TYPE"], 
+		parameters["DATASET"], parameters["CLASSIFIER_TYPE"], 
+		threshold, seed)
+
+	# Adjustment to load state_dict from ckpt generated by PyTorch-Lightning
+	state_dict = torch.load(model_path, map_location=torch.device(parameters['DEVICE']))['state_dict']
+
+	for key in list(state_dict.keys()):
+		state_dict[key.replace('model.model.', 'model.')] = state_dict.pop(key)
+
+	classifier.load_state_dict(state_dict)
+	classifier.eval()
+
+	classifier.to(parameters["DEVICE"])
+
+	return classifier
+
+def load_classifiers(parameters, thresholds):
+	"""
+	Loading classifiers of all seeds for each given threshold, so that
+	they could be reused between runs.
+
+	parameters - DICT with values of keys: SEEDS and the ones required by load_classifier
+	thresholds - LIST of temperature thresholds (STRING) to load classifiers for
+
+	returns DICT with thresholds as keys and DICT (seeds as keys, classifiers as values) as values
+	"""
+	classifiers = {}
+	for threshold in thresholds:
+		classifiers[threshold] = {}
+		for seed in parameters["SEEDS"]:
+			classifiers[threshold][seed] = load_classifier(parameters, threshold, seed)
+	return classifiers
+
 def make_inferences(sequences, per_res_sequences, mean_loader, per_res_loader, 
-	parameters, thresholds_range): 
+	parameters, thresholds_range, classifiers=None): 
 	"""
 	Making inferences.
    
@@ -107,6 +156,8 @@ def make_inferences(sequences, per_res_sequences, mean_loader, per_res_loader,
 	hidden_layer_sizes - LIST with sizes (INT) of the hidden layers of classifiers
 	parameters - DICT with values of keys: THRESHOLDS, SEEDS, HIDDEN_LAYER_SIZES, CLASSIFIERS_DIR, EMB_TYPE, DATASET, CLASSIFIER_TYPE
 	thresholds_range - STRING to determine, which thresholds to choose
+	classifiers - DICT of preloaded classifiers (see load_classifiers). If None,
+		classifiers are loaded from CLASSIFIERS_DIR
 
 	returns (DICT, DICT, DICT, DICT)
 	"""
@@ -118,24 +169,10 @@ def make_inferences(sequences, per_res_sequences, mean_loader, per_res_loader,
 		for threshold in parameters["THRESHOLDS"][thresholds_range]:
 			threshold_inferences = {}
 			for seed in parameters["SEEDS"]:
-				classifier = MLP_C2H2(parameters["INPUT_SIZE"], 
-					parameters["HIDDEN_LAYER_SIZES"][0],
-					parameters["HIDDEN_LAYER_SIZES"][1])
-				model_path = "%s/%s_%s_%s-%s_s%s.pt" % (
-					parameters["CLASSIFIERS_DIR"], parameters["EMB_TYPE"], 
-					parameters["DATASET"], parameters["CLASSIFIER_TYPE"], 
-					threshold, seed)
-
-				# Adjustment to load state_dict from ckpt generated by PyTorch-Lightning
-				state_dict = torch.load(model_path, map_location=torch.device(parameters['DEVICE']))['state_dict']
-
-				for key in list(state_dict.keys()):
-					state_dict[key.replace('model.model.', 'model.')] = state_dict.pop(key)
-
-				classifier.load_state_dict(state_dict)
-				classifier.eval()
-
-				classifier.to(parameters["DEVICE"])
+				if(classifiers is not None):
+					classifier = classifiers[threshold][seed]
+				else:
+					classifier = load_classifier(parameters, threshold, seed)
 
 				threshold_inferences[seed] = inference_epoch(classifier,
 					loader,
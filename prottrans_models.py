@@ -7,12 +7,15 @@ from transformers import T5EncoderModel, T5Tokenizer
 import torch
 import os
 import sys
+import tempfile
 from hashlib import sha256
 
-def get_pretrained_model(model_path):
+def get_pretrained_model(model_path, torch_dtype=None):
     """
     Fetches the model accordingly to the model_path
     model_path - STRING that identifies the model to fetch
+    torch_dtype - torch.dtype in which to load the weights (default 
+        precision if None)
     Returns model.
     """
 
@@ -20,9 +23,10 @@ def get_pretrained_model(model_path):
     if(os.path.exists(model_path+'/pytorch_model.bin') and 
         os.path.exists(model_path+'/config.json')):
         model = T5EncoderModel.from_pretrained(model_path+'/pytorch_model.bin', 
-                    config=model_path+'/config.json')
+                    config=model_path+'/config.json', torch_dtype=torch_dtype)
     else:
-        model = T5EncoderModel.from_pretrained(model_path)
+        model = T5EncoderModel.from_pretrained(model_path, 
+                    torch_dtype=torch_dtype)
     model = model.to(device)
     model = model.eval()
 
@@ -39,13 +43,15 @@ def get_tokenizer(model_path):
     tokenizer = T5Tokenizer.from_pretrained(model_path, do_lower_case=False)	
     return tokenizer
 
-def load_model_and_tokenizer(pt_dir, pt_server_path):
+def load_model_and_tokenizer(pt_dir, pt_server_path, torch_dtype=None):
     """
     Load ProtTrans model and tokenizer.
     
     pt_dir - STRING to determine the path to the directory with ProtTrans 
         "pytorch_model.bin" file
     pt_server_path - STRING of the path to ProtTrans model in its server
+    torch_dtype - torch.dtype in which to load the model (default 
+        precision if None)
     
     returns (ProtT5-XL model, tokenizer)
     """
@@ -54,10 +60,10 @@ def load_model_and_tokenizer(pt_dir, pt_server_path):
 
     if(os.path.isfile(f"{pt_dir}/pytorch_model.bin")):
         # Only loading the model
-        model = get_pretrained_model(pt_dir)
+        model = get_pretrained_model(pt_dir, torch_dtype)
     else:
         # Downloading and saving the model
-        model = get_pretrained_model(pt_server_path)
+        model = get_pretrained_model(pt_server_path, torch_dtype)
         model.save_pretrained(pt_dir)
 
     if(os.path.isfile(f"{pt_dir}/tokenizer_config.json")):
@@ -99,10 +105,90 @@ def process_FASTA(fasta_path, split_char="!", id_field=0):
 
     return (seqs, orig_seq_headers, orig_seqs)
 
+def get_padding_fraction(batch, seq_len):
+    """
+    Calculating the fraction of padding tokens in a batch if a sequence
+    was added to it.
+
+    batch - LIST of (id, spaced sequence, length) tuples sorted by length in 
+        descending order
+    seq_len - INT length of the sequence to add
+
+    returns FLOAT
+    """
+    longest = max(batch[0][2], seq_len)
+    n_residues = sum([s_len for _, _, s_len in batch]) + seq_len
+    return 1 - n_residues/(longest*(len(batch)+1))
+
+def release_cuda_cache(min_free_memory):
+    """
+    Releasing blocks cached by the CUDA allocator when free device memory
+    gets low, which prevents fragmentation from building up across batches
+    of different lengths without paying the cost of emptying the cache
+    after every batch.
+
+    min_free_memory - FLOAT fraction of the device memory that should stay 
+        free, or None to never release the cache
+    """
+    if(min_free_memory is None or not torch.cuda.is_available()): return
+
+    free, total = torch.cuda.mem_get_info()
+    if(free/total < min_free_memory):
+        torch.cuda.empty_cache()
+
+def embed_batch(model, tokenizer, batch, results, per_residue, per_protein,
+    pad_to_multiple_of=None):
+    """
+    Generation of embeddings for a single padded batch with one forward pass.
+
+    batch - LIST of (id, spaced sequence, length) tuples
+    results - DICT with keys 'per_res_representations' and 
+        'mean_representations', to which the embeddings are added
+    per_residue, per_protein - BOOL as in get_embeddings
+    pad_to_multiple_of - INT to which the padded length is rounded up, so 
+        that batches fall into a fixed set of shapes (e.g. for compiled 
+        models), or None to pad to the longest sequence only
+    """
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+
+    pdb_ids, seqs, seq_lens = zip(*batch)
+
+    token_encoding = tokenizer.batch_encode_plus(seqs, 
+        add_special_tokens=True, padding='longest', 
+        pad_to_multiple_of=pad_to_multiple_of, return_tensors='pt')
+    input_ids = token_encoding['input_ids'].to(device)
+    attention_mask = token_encoding['attention_mask'].to(device)
+    
+    try:
+        with torch.inference_mode():
+            embedding_repr = model(input_ids, 
+                attention_mask=attention_mask)
+    except RuntimeError:
+        print(f"{sys.argv[0]}: runtime error generating embedding for {pdb_ids[-1]} (L={seq_lens[-1]}). "+\
+            f"Try lowering batch size. If single sequence processing does not work, you need "+\
+            f"more vRAM to process your protein.", file=sys.stderr)
+        return
+
+    for batch_idx, identifier in enumerate(pdb_ids):
+        s_len = seq_lens[batch_idx]
+        # Pooling and caching in full precision also for half-precision models
+        emb = embedding_repr.last_hidden_state[batch_idx,:s_len].float()
+        if per_residue:
+            results["per_res_representations"][identifier] = \
+                emb.detach().cpu().numpy().squeeze()
+        if per_protein:
+            protein_emb = emb.mean(dim=0)
+            results["mean_representations"][identifier] = \
+                protein_emb.detach().cpu().numpy().squeeze()
+
 def get_embeddings(model, tokenizer, seqs, per_residue, per_protein, 
                     max_residues=4000, # number of cumulative residues per batch
                     max_seq_len=2000, # max length after which we switch to single-sequence processing to avoid OOM
-                    max_batch=100 # max number of sequences per single batch
+                    max_batch=100, # max number of sequences per single batch
+                    max_padding=None, # max fraction of padding tokens per batch (no limit if None)
+                    pad_to_multiple_of=None, # padded length rounding (see embed_batch)
+                    min_free_memory=None # free device memory fraction below which the CUDA cache is released
     ):
     """
     Generation of embeddings via batch-processing.
@@ -111,11 +197,13 @@ def get_embeddings(model, tokenizer, seqs, per_residue, per_protein,
     per_protein indicates that embeddings for a whole protein should be
         returned (average-pooling).
 
+    Sequences are sorted by length, so each batch is a length bucket padded
+    to its longest sequence. max_padding additionally starts a new batch
+    whenever adding a sequence would make the padding exceed that fraction.
+
     returns results depending on the option in the input.
     """
 
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-
     results = {'per_res_representations': dict(),
 		'mean_representations': dict()}
     seq_dict = sorted(seqs.items(), key=lambda kv: len(seqs[kv[0]]), 
@@ -125,41 +213,24 @@ def get_embeddings(model, tokenizer, seqs, per_residue, per_protein,
     for seq_idx, (pdb_id, seq) in enumerate(seq_dict, 1):
         seq_len = len(seq)
         seq = ' '.join(list(seq))
+
+        if (max_padding is not None and len(batch) and 
+            get_padding_fraction(batch, seq_len) > max_padding):
+            embed_batch(model, tokenizer, batch, results, per_residue, 
+                per_protein, pad_to_multiple_of)
+            release_cuda_cache(min_free_memory)
+            batch = list()
+
         batch.append((pdb_id, seq, seq_len))
 
         n_res_batch = sum([s_len for _, _, s_len in batch]) + seq_len
 
         if (len(batch) >= max_batch) or (n_res_batch >= max_residues) or (seq_idx == len(seq_dict)) or (seq_len > max_seq_len):
-            pdb_ids, seqs, seq_lens = zip(*batch)
+            embed_batch(model, tokenizer, batch, results, per_residue, 
+                per_protein, pad_to_multiple_of)
+            release_cuda_cache(min_free_memory)
             batch = list()
 
-            token_encoding = tokenizer.batch_encode_plus(seqs, 
-                add_special_tokens=True, padding='longest')
-            input_ids = torch.tensor(token_encoding['input_ids']).to(device)
-            attention_mask = torch.tensor(
-                token_encoding['attention_mask']).to(device)
-            
-            try:
-                with torch.no_grad():
-                    embedding_repr = model(input_ids, 
-                        attention_mask=attention_mask)
-            except RuntimeError:
-                print(f"{sys.argv[0]}: runtime error generating embedding for {pdb_id} (L={seq_len}). "+\
-                    f"Try lowering batch size. If single sequence processing does not work, you need "+\
-                    f"more vRAM to process your protein.", file=sys.stderr)
-                continue
-
-            for batch_idx, identifier in enumerate(pdb_ids):
-                s_len = seq_lens[batch_idx]
-                emb = embedding_repr.last_hidden_state[batch_idx,:s_len]
-                if per_residue:
-                    results["per_res_representations"][identifier] = \
-                        emb.detach().cpu().numpy().squeeze()
-                if per_protein:
-                    protein_emb = emb.mean(dim=0)
-                    results["mean_representations"][identifier] = \
-                        protein_emb.detach().cpu().numpy().squeeze()
-
     return results
 
 def save_embeddings(sequences, embeddings, embeddings_directory, embedding_type="mean"):
@@ -180,7 +251,14 @@ def save_embeddings(sequences, embeddings, embeddings_directory, embedding_type=
             seq_data[embedding_type_key] = torch.from_numpy(
                 embeddings[embedding_type_key][seq_id])
         seq_code = sha256(sequences[seq_id].encode('utf-8')).hexdigest()
-        torch.save(seq_data, f"{embeddings_directory}/{embedding_type}_{seq_code}.pt")
+        # Writing to a temporary file first, so that concurrent runs sharing
+        # the directory never load a partially written embedding
+        emb_fd, emb_tmp_path = tempfile.mkstemp(dir=embeddings_directory, 
+            suffix=".tmp")
+        with os.fdopen(emb_fd, "wb") as emb_file:
+            torch.save(seq_data, emb_file)
+        os.replace(emb_tmp_path, 
+            f"{embeddings_directory}/{embedding_type}_{seq_code}.pt")
 
 def print_embeddings_generation_stats(iteration, portion_size, embeddings, 
     seqs_wo_emb, start_time, end_time):
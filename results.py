@@ -3,7 +3,6 @@ Representing the output of the program.
 """
 
 import numpy
-import matplotlib.pyplot as plt
 
 def get_temperature_label(predictions, temperature_ranges, left_hand=True):
     """
@@ -167,6 +166,9 @@ def plot_per_res_inferences(averaged_inferences, thresholds, plot_dir,
         be saved
     smoothen - BOOL indicates to plot smoothened curve
     """
+    # Importing matplotlib only when plots are requested
+    import matplotlib.pyplot as plt
+
     WINDOW_SIZE = window_size
 
     original_seq_ids = set()
@@ -242,3 +244,7 @@ def plot_inferences(per_res_out, per_segment_out, averaged_inferences, threshold
             window_size=window_size,
             x_label=f"segment (k={segment_size}) index",
         title="Per-segment predictions")
+
+    # Releasing figures so that repeated in-process runs start clean
+    import matplotlib.pyplot as plt
+    plt.close("all")